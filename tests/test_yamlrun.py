@@ -1,5 +1,209 @@
+import errno
+import io
+import os
+import sys
+
+import pytest
+
 from yamlrun import __version__
+from yamlrun.yaml import Yaml
+from yamlrun.__main__ import parse_args, run
 
 
 def test_version():
     assert __version__ == '0.1.0'
+
+
+def test_replace_variables_single_pass(tmp_path):
+    path = tmp_path / 'main.yaml'
+    path.write_text('structure: yaml\n')
+    yaml = Yaml(str(path), quiet=True, noenv=True)
+    yaml.variables = {'a': '$b', 'b': 'literal'}
+    assert yaml._replace_variables('$a and $b') == '$b and literal'
+    assert yaml._replace_variables('$b') == 'literal'
+
+
+def test_replace_variables_braces(tmp_path):
+    path = tmp_path / 'main.yaml'
+    path.write_text(
+        'variables:\n'
+        '  - a: value\n'
+        "  - d: {k: nested}\n"
+    )
+    yaml = Yaml(str(path), quiet=True, noenv=True)
+    yaml.parse_structure()
+    yaml.parse_variables()
+    assert yaml._replace_variables('${a}') == 'value'
+    assert yaml._replace_variables('x${a}y') == 'xvaluey'
+    assert yaml._replace_variables("${d['k']}") == 'nested'
+    assert yaml._replace_variables('${a') == '${a'
+    assert yaml._replace_variables('$a}') == 'value}'
+
+
+def test_replace_variables_subkeys(tmp_path):
+    path = tmp_path / 'main.yaml'
+    path.write_text(
+        'variables:\n'
+        "  - l: [zero, [one]]\n"
+        "  - d: {'2020': year}\n"
+        "  - s: text\n"
+        "  - idx: '1'\n"
+    )
+    yaml = Yaml(str(path), quiet=True, noenv=True)
+    yaml.parse_structure()
+    yaml.parse_variables()
+    assert yaml._replace_variables('$l[0]') == 'zero'
+    assert yaml._replace_variables('$l[1][0]') == 'one'
+    assert yaml._replace_variables('$l[$idx]') == ['one']
+    assert yaml._replace_variables("$d['2020']") == 'year'
+    assert yaml._replace_variables('$l[9]') == '$l[9]'
+    assert yaml._replace_variables("$s['x']") == "$s['x']"
+
+
+def test_parse_args(monkeypatch):
+    monkeypatch.setattr(sys, 'argv', ['yamlrun', 'main.yaml', '--noenv'])
+    assert parse_args() == ('main.yaml', False, True)
+    monkeypatch.setattr(sys, 'argv', ['yamlrun', '-q', '--', 'main.yaml'])
+    assert parse_args() == ('main.yaml', True, False)
+
+
+def test_replace_variables_after_update(tmp_path):
+    path = tmp_path / 'main.yaml'
+    path.write_text(
+        'variables:\n'
+        '  - greeting: hello\n'
+    )
+    yaml = Yaml(str(path), quiet=True, noenv=True)
+    yaml.parse_structure()
+    yaml.parse_variables()
+    assert yaml._replace_variables('say $greeting') == 'say hello'
+    yaml.variables['greeting'] = 'changed'
+    assert yaml._replace_variables('say $greeting') == 'say changed'
+
+
+def test_run_script_replace_process(tmp_path, monkeypatch):
+    path = tmp_path / 'main.yaml'
+    path.write_text(
+        'script:\n'
+        f'  cd: {tmp_path}\n'
+        '  run:\n'
+        '    - missing-command "a b"\n'
+    )
+    calls = []
+    monkeypatch.setattr(
+        os, 'dup2', lambda fd, fd2: calls.append(('dup2', fd2)))
+    monkeypatch.setattr(
+        os, 'chdir', lambda path: calls.append(('chdir', path)))
+
+    def execvp(file, args):
+        calls.append(('execvp', file, args))
+        raise FileNotFoundError(file)
+
+    monkeypatch.setattr(os, 'execvp', execvp)
+    yaml = Yaml(str(path), quiet=True, noenv=True)
+    yaml.parse_structure()
+    yaml.parse_variables()
+    with pytest.raises(FileNotFoundError):
+        yaml.run_script(replace_process=True)
+    assert calls == [
+        ('dup2', 0),
+        ('chdir', str(tmp_path)),
+        ('execvp', 'missing-command', ['missing-command', 'a b']),
+        ('chdir', os.getcwd()),
+        ('dup2', 0),
+    ]
+
+
+def test_run_script_replace_process_windows(tmp_path, monkeypatch):
+    path = tmp_path / 'main.yaml'
+    path.write_text(
+        'script:\n'
+        f'  cd: {tmp_path}\n'
+        '  run:\n'
+        '    - echo hi\n'
+    )
+    run = []
+    monkeypatch.setattr(os, 'name', 'nt')
+    monkeypatch.setattr(
+        Yaml, '_exec_command', lambda self, cmd, cwd: pytest.fail())
+    monkeypatch.setattr(
+        Yaml, '_run_command', lambda self, cmd, cwd: run.append(cmd))
+    yaml = Yaml(str(path), quiet=True, noenv=True)
+    yaml.parse_structure()
+    yaml.parse_variables()
+    yaml.run_script(replace_process=True)
+    assert run == ['echo hi']
+
+
+def test_run_exit_code(tmp_path, monkeypatch):
+    path = tmp_path / 'main.yaml'
+    path.write_text(
+        'script:\n'
+        f'  cd: {tmp_path}\n'
+        '  run:\n'
+        '    - echo hi\n'
+        '    - sh -c "exit 3"\n'
+    )
+    monkeypatch.setattr(sys, 'argv', ['yamlrun', '-q', str(path)])
+    with pytest.raises(SystemExit) as e:
+        run()
+    assert e.value.code == 3
+
+
+def test_parse_structure_above_root(tmp_path):
+    path = tmp_path / 'main.yaml'
+    depth = len(str(tmp_path).split(os.sep))
+    sections = [f'level{i}' for i in range(depth + 2)]
+    path.write_text('structure: ' + '/'.join(sections + ['yaml']) + '\n')
+    yaml = Yaml(str(path), quiet=True)
+    yaml.parse_structure()
+    assert yaml.variables['yaml_name'] == 'main.yaml'
+    assert yaml.variables['yaml_path'] == str(path)
+    # Walk up with dirname and basename, which stay at the root
+    abspath = str(path)
+    for var in reversed(sections):
+        abspath = os.path.dirname(abspath)
+        assert yaml.variables[f'{var}_path'] == abspath
+        assert yaml.variables[f'{var}_name'] == os.path.basename(abspath)
+    root = os.path.abspath(os.sep)
+    assert yaml.variables['level0_path'] == root
+    assert yaml.variables['level0_name'] == ''
+
+
+def test_run_command_text_stdout(tmp_path, monkeypatch):
+    path = tmp_path / 'main.yaml'
+    path.write_text('structure: yaml\n')
+    stdout = io.StringIO()
+    monkeypatch.setattr(sys, 'stdout', stdout)
+    Yaml(str(path), quiet=True)._run_command('echo hi', str(tmp_path))
+    assert stdout.getvalue() == 'hi\n\n'
+
+
+def test_exec_command_closed_stdin(tmp_path, monkeypatch):
+    path = tmp_path / 'main.yaml'
+    path.write_text('structure: yaml\n')
+    calls = []
+
+    def dup(fd):
+        raise OSError(errno.EBADF, os.strerror(errno.EBADF))
+
+    def execvp(file, args):
+        calls.append(('execvp', args))
+        raise FileNotFoundError(file)
+
+    monkeypatch.setattr(os, 'dup', dup)
+    monkeypatch.setattr(
+        os, 'dup2', lambda fd, fd2: calls.append(('dup2', fd2)))
+    monkeypatch.setattr(
+        os, 'chdir', lambda path: calls.append(('chdir', path)))
+    monkeypatch.setattr(os, 'execvp', execvp)
+    yaml = Yaml(str(path), quiet=True)
+    with pytest.raises(FileNotFoundError):
+        yaml._exec_command('missing-command', str(tmp_path))
+    # There is no saved stdin to restore
+    assert calls == [
+        ('dup2', 0),
+        ('chdir', str(tmp_path)),
+        ('execvp', ['missing-command']),
+        ('chdir', os.getcwd()),
+    ]
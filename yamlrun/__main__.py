@@ -1,12 +1,13 @@
-import argparse
-from .yaml import Yaml
+import sys
+from .yaml import Yaml, CommandError
 
 
-def parse_args():
+def _build_parser():
     """
-    Load the YAML file path as a positional argument
+    Build the argparse parser, used for --help and invalid arguments
 
     """
+    import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument(
         'yaml',
@@ -25,23 +26,42 @@ def parse_args():
         action='store_true',
         help='Whether to look for variables in environment values'
     )
-    args = parser.parse_args().__dict__
-    yaml_path = args['yaml'][0]
-    quiet = args['q']
-    noenv = args['noenv']
+    return parser
+
+
+def parse_args():
+    """
+    Load the YAML file path as a positional argument
+
+    """
+    argv = sys.argv[1:]
+    quiet = '-q' in argv
+    noenv = '--noenv' in argv
+    remaining = [arg for arg in argv if arg not in ('-q', '--noenv')]
+    # Fall back to argparse for --help, usage errors and unusual arguments
+    if len(remaining) != 1 or remaining[0].startswith('-'):
+        args = _build_parser().parse_args().__dict__
+        return args['yaml'][0], args['q'], args['noenv']
+    yaml_path = remaining[0]
     return yaml_path, quiet, noenv
 
 
 def run():
     """
     Load variables from YAML file and run script
+    If a command fails, exit with its exit code
 
     """
     args = parse_args()
     yaml = Yaml(*args)
     yaml.parse_structure()
     yaml.parse_variables()
-    yaml.run_script()
+    # Exit with the failed command's exit code, as single commands do
+    try:
+        yaml.run_script(replace_process=True)
+    except CommandError as e:
+        print(e, file=sys.stderr)
+        sys.exit(e.returncode)
 
 
 if __name__ == "__main__":
@@ -1,13 +1,71 @@
 import os
 import re
 import json
+import locale
+import sys
 import shlex
 import subprocess
+from functools import lru_cache
+from typing import Tuple
 
-from yaml import safe_load
+from yaml import load
+try:
+    from yaml import CSafeLoader as _SafeLoader
+except ImportError:
+    from yaml import SafeLoader as _SafeLoader
 from yaml.parser import ParserError
-from tabulate import tabulate
-from pprint import pprint
+
+
+# Find all $ or ${} variables in a string, including any ['subkey'] parts
+_QUOTES = '(?:"|\')'
+_ALPHANUMS_IN_SQUARE_BRACKETS = \
+    '(?:'                                                   + \
+        r'(?:\[' + _QUOTES + r'[\w_]+' + _QUOTES + r'\])'   + \
+        '|'                                                 + \
+        r'(?:\[\$[\w_]+\])'                                 + \
+        '|'                                                 + \
+        r'(?:\[\d+\])'                                      + \
+    ')*'
+_VAR_RE = re.compile(
+    r'\$(?P<brace>{)?'                                      + \
+    r'(?P<name>[\w_]+)'                                     + \
+    '(?P<subkeys>' + _ALPHANUMS_IN_SQUARE_BRACKETS + ')'    + \
+    '(?(brace)})'
+)
+# Subkeys of a variable, e.g. "['mypath'][$arg]" -> ["mypath", "$arg"]
+_SUBKEY_RE = re.compile(r'\[(?:\'|")*(.*?)(?:\'|")*\]')  # ['.*']
+# Sentinel for values missing from a cache
+_MISSING = object()
+
+
+class CommandError(RuntimeError):
+    """
+    Raised when a script command exits with a non-zero exit code
+
+    Parameters
+    ----------
+    message: str
+        Error message
+    returncode: int
+        Exit code of the command
+
+    """
+    def __init__(
+        self,
+        message: str,
+        returncode: int
+    ):
+        super().__init__(message)
+        self.returncode = returncode
+
+
+@lru_cache(maxsize=256)
+def _tokenize(command_str: str) -> Tuple[str, ...]:
+    """
+    Split a command string into arguments, caching repeated commands
+
+    """
+    return tuple(shlex.split(command_str, posix=True))
 
 
 class Yaml(dict):
@@ -36,11 +94,12 @@ class Yaml(dict):
         self.path = path
         self.quiet = quiet
         self.noenv = noenv
+        self._env_cache = {}
         if not os.path.exists(path):
             raise ValueError(f'File does not exist: {path}')
-        with open(path, 'r') as stream:
+        with open(path, 'rb') as stream:
             try:
-                super().__init__(safe_load(stream))
+                super().__init__(load(stream, Loader=_SafeLoader))
             except TypeError:
                 raise ParserError("yaml file is empty")
 
@@ -56,6 +115,7 @@ class Yaml(dict):
         Verbose pretty print: does not print if self.quiet is True
         """
         if not self.quiet:
+            from pprint import pprint
             pprint(*args, **kwargs)
             print('\n')
 
@@ -85,18 +145,26 @@ class Yaml(dict):
         self.variables = {'structure': structure}
         # Parse structure and find structure dirnames and abspaths
         abspath = os.path.abspath(self.path)
-        filename = os.path.basename(abspath)
+        dirpath, filename = os.path.split(abspath)
         paths = [('yaml', filename, abspath)]
-        for var in structure.split('/')[-2::-1]:
-            abspath = os.path.dirname(abspath)
-            dirname = os.path.basename(abspath)
-            paths.insert(0, (var, dirname, abspath))
+        sections = structure.split('/')
+        for var in reversed(sections[:-1]):
+            # Walking up from the root directory stays at the root
+            parent, dirname = os.path.split(dirpath)
+            paths.append((var, dirname, dirpath))
+            dirpath = parent
+        paths.reverse()
         # Store as dict
-        self.variables.update({f'{s}_name': n for s, n, _ in paths})
-        self.variables.update({f'{s}_path': p for s, _, p in paths})
+        variables = self.variables
+        for s, n, p in paths:
+            variables[f'{s}_name'] = n
+            variables[f'{s}_path'] = p
         # Print
-        self.print('Detected structure:\n')
-        self.print(tabulate(paths, headers=['SECTION', 'NAME', 'PATH']), '\n')
+        if not self.quiet:
+            from tabulate import tabulate
+            self.print('Detected structure:\n')
+            self.print(
+                tabulate(paths, headers=['SECTION', 'NAME', 'PATH']), '\n')
 
     def parse_variables(
         self
@@ -116,9 +184,8 @@ class Yaml(dict):
 
         """
         # Parse variables
-        parsed = {}
-        for item in self.get('variables', []):
-            parsed.update(item)
+        items = self.get('variables', []) or []
+        parsed = {k: v for item in items for k, v in item.items()}
         # Replace any $variables with their associated value
         for parsed_key, parsed_val in parsed.items():
             if isinstance(parsed_val, str):
@@ -142,63 +209,66 @@ class Yaml(dict):
         ----------
         parsed_str: str
             String parsed from the yaml `variables` tag
+        add_quotes: bool
+            Whether to quote collections (dict or list) inserted in the string
 
         """
-        # Find all $ or ${} variables in the string 
-        quotes = '(?:"|\')'
-        alphanums_in_square_brackets = \
-            '(?:'                                                   + \
-                '(?:\[' + quotes + '[\w_]+' + quotes + '\])'        + \
-                '|'                                                 + \
-                '(?:\[\$[\w_]+\])'                                  + \
-                '|'                                                 + \
-                '(?:\[\d+\])'                                       + \
-            ')*'
-        pattern = \
-            '('                                                     + \
-                r'\$[\w_]+' + alphanums_in_square_brackets          + \
-                '|'                                                 + \
-                r'\${[\w_]+' + alphanums_in_square_brackets + '}'   + \
-            ')'
-        parsed_variables = re.findall(pattern, parsed_str)
-        var_replacements = {k: k for k in parsed_variables}
-        # Find a replacement for each parsed variable
-        for var in parsed_variables:
+        # Nothing to replace without a $ sign
+        if '$' not in parsed_str:
+            return parsed_str
+        variables = self.variables
+        environ = self._environ
+
+        def _resolve(match):
+            var = match.group(0)
             # Split var into subkeys if var is of the form $variable['subkey']
             # E.g. "$PATHS['mypath'][$arg']" -> ["$PATHS", "mypath", "$arg"]
-            regex = '\[' + '(?:\'|")*' + '(.*?)' + '(?:\'|")*' + '\]'  # ['.*']
-            subkeys = re.findall(regex, var)
-            subkeys.insert(0, re.findall('^\${?[\w_]+}?', var)[0])
+            subkeys = _SUBKEY_RE.findall(match.group('subkeys'))
+            subkeys.insert(0, '$' + match.group('name'))
             # Replace any $variable subkeys with the associated value
             for i, key in enumerate(subkeys):
                 if key.startswith('$'):
-                    key = key.strip('${}')
-                    subkeys[i] = self.variables.get(key, self._environ(key))
+                    key = key[1:]
+                    subkeys[i] = \
+                        variables[key] if key in variables else environ(key)
             # If it's a collection (dict or list), iteratively get the element
             try:
                 replacement = subkeys[0]
-                #print(replacement)
                 for k in subkeys[1:]:
-                    if isinstance(replacement, list):
-                        replacement = replacement[int(k)]
-                    else:
+                    try:
                         replacement = replacement[k]
-                var_replacements[var] = replacement
-            except:
-                pass
-        # Now replace all occurences of that variable in the parsed string
-        for var, replacement in var_replacements.items():
-            if var == parsed_str and not add_quotes:
-                parsed_str = replacement
+                    except TypeError:
+                        # List indices are parsed as strings
+                        if not isinstance(replacement, list):
+                            raise
+                        replacement = replacement[int(k)]
+            except (KeyError, IndexError, TypeError, ValueError):
+                return var
+            return replacement
+
+        # Serialise each collection once, however often it appears
+        json_cache = {}
+
+        def _stringify(replacement):
+            if isinstance(replacement, (list, dict)):
+                dumped = json_cache.get(id(replacement))
+                if dumped is None:
+                    dumped = json.dumps(replacement, indent=4)
+                    json_cache[id(replacement)] = dumped
+                replacement = dumped
+                if add_quotes:
+                    replacement = "'" + replacement + "'"
             else:
-                if isinstance(replacement, (list, dict)):
-                    replacement = json.dumps(replacement, indent=4)
-                    if add_quotes:
-                        replacement = "'" + replacement + "'"
-                else:
-                    replacement = str(replacement)
-                parsed_str = parsed_str.replace(var, replacement)
-        return parsed_str
+                replacement = str(replacement)
+            return replacement
+
+        # A single variable spanning the whole string keeps its type
+        if not add_quotes and parsed_str.startswith('$'):
+            match = _VAR_RE.fullmatch(parsed_str)
+            if match:
+                return _resolve(match)
+        # Otherwise replace each $ or ${} variable in a single pass
+        return _VAR_RE.sub(lambda m: _stringify(_resolve(m)), parsed_str)
     
     def _environ(
         self,
@@ -206,6 +276,7 @@ class Yaml(dict):
     ):
         """
         Get env variable if noenv is False
+        Lookups are cached for the lifetime of the Yaml object
 
         Parameters
         ----------
@@ -213,17 +284,31 @@ class Yaml(dict):
             Environment variable name
 
         """
-        if not self.noenv:
-            return os.environ.get(name, '')
-        else:
+        if self.noenv:
             return ''
+        value = self._env_cache.get(name, _MISSING)
+        if value is _MISSING:
+            value = self._env_cache[name] = os.environ.get(name, '')
+        return value
 
     def run_script(
-        self
+        self,
+        replace_process: bool=False
     ):
         """
         Parse YAML script, replace the variables and run in subprocess
 
+        Parameters
+        ----------
+        replace_process: bool
+            If the script is a single command, replace the current process
+            with it instead of running it in a subprocess. The command's
+            exit code then becomes the exit code of the process, and its
+            output goes straight to stdout: literal \\n sequences are not
+            expanded and no newline is printed after the output. Only used
+            on POSIX: on Windows, os.execvp starts a new process and exits
+            without waiting for it
+
         """
         script = self.get('script')
         cwd = script.get('cd', '$yaml_path')
@@ -232,16 +317,62 @@ class Yaml(dict):
         commands = [
             self._replace_variables(cmd, add_quotes=True) for cmd in commands]
         self.print('Running script:\n')
+        if replace_process and len(commands) == 1 and os.name == 'posix':
+            self._exec_command(commands[0], cwd)
         for cmd in commands:
             self._run_command(cmd, cwd)
-    
+
+    def _exec_command(
+        self,
+        command_str: str,
+        cwd: str
+    ):
+        """
+        Replace the current process with a command. Like _run_command, the
+        command gets an empty stdin. If the command can't be executed, the
+        working directory and stdin (unless it was closed) are restored
+        before raising
+
+        Parameters
+        ----------
+        command_str: str
+            Command to execute, as a string
+        cwd: str
+            Directory to run the command from
+
+        """
+        command_list = list(_tokenize(command_str))
+        sys.stdout.flush()
+        prev_cwd = os.getcwd()
+        # stdin may already be closed, in which case there's nothing to restore
+        try:
+            stdin = os.dup(0)
+        except OSError:
+            stdin = None
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        try:
+            os.dup2(devnull, 0)
+            os.chdir(cwd)
+            os.execvp(command_list[0], command_list)
+        except OSError:
+            os.chdir(prev_cwd)
+            if stdin is not None:
+                os.dup2(stdin, 0)
+            raise
+        finally:
+            # With stdin closed, os.devnull is opened as fd 0: keep it open
+            if devnull != 0:
+                os.close(devnull)
+            if stdin is not None:
+                os.close(stdin)
+
     def _run_command(
         self,
         command_str: str,
         cwd: str
     ):
         """
-        Execute a command, wait for it to finish and display the output
+        Execute a command and stream its output until it finishes
 
         Parameters
         ----------
@@ -251,17 +382,29 @@ class Yaml(dict):
             Directory to run the command from
 
         """
-        command_list = shlex.split(command_str)
-        r = subprocess.run(
+        command_list = list(_tokenize(command_str))
+        with subprocess.Popen(
             command_list,
-            stdin=subprocess.PIPE,
+            stdin=subprocess.DEVNULL,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
-            universal_newlines=True,
             cwd=cwd
-        )
-        print(r.stdout.replace('\\n', '\n'))
-        if r.returncode != 0:
-            raise RuntimeError(
-                'Command `%s` failed.\nExit code %s: %s' % \
-                (command_list, r.returncode, r.stderr))
+        ) as p:
+            # Stream the raw output bytes line by line as the command runs
+            sys.stdout.flush()
+            # Text-only stdouts (e.g. io.StringIO, notebooks) have no buffer
+            out = getattr(sys.stdout, 'buffer', None)
+            encoding = locale.getpreferredencoding(False)
+            for line in p.stdout:
+                line = line.replace(b'\\n', b'\n')
+                if out is None:
+                    sys.stdout.write(line.decode(encoding, 'replace'))
+                else:
+                    out.write(line)
+                    out.flush()
+            returncode = p.wait()
+        print()
+        if returncode != 0:
+            raise CommandError(
+                'Command `%s` failed.\nExit code %s' % \
+                (command_list, returncode), returncode)